@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 import os
 import re
-import io
+import base64
 import asyncio
+import hashlib
 import logging
-from contextlib import suppress
+import time
+from functools import lru_cache
+from contextlib import suppress, asynccontextmanager
 from dataclasses import dataclass
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 from telegram import (
     Update,
@@ -18,6 +25,7 @@ from telegram import (
     InputFile,
 )
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     ContextTypes,
@@ -26,7 +34,7 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout, Frame
+from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeout, Frame
 
 # ---------- ENV ----------
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -37,22 +45,42 @@ WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or (f"webhook/{WEBHOOK_SECRET_TOKEN or
 PORT = int(os.getenv("PORT", "8000"))
 DATABASE_URL = os.getenv("DATABASE_URL")
 SECRET_KEY = os.getenv("SECRET_KEY")
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "90"))
+BROWSERLESS_KEEPALIVE_MS = int(os.getenv("BROWSERLESS_KEEPALIVE_MS", "60000"))
+BROWSER_PING_INTERVAL = float(os.getenv("BROWSER_PING_INTERVAL", "30"))
+BROWSER_IDLE_TTL = float(os.getenv("BROWSER_IDLE_TTL", "600"))  # простой, после которого отпускаем сессию Browserless
+# предельная жизнь сессии Browserless (?timeout=), а не простой: при постоянной нагрузке подключение
+# пересоздаётся заранее (см. browser_context), чтобы Browserless не оборвал его посреди проверки; 0 — не передаём
+BROWSERLESS_SESSION_TIMEOUT_MS = int(os.getenv("BROWSERLESS_SESSION_TIMEOUT_MS") or (BROWSER_IDLE_TTL + 300) * 1000)
+PORTAL_SESSION_TTL = float(os.getenv("PORTAL_SESSION_TTL", "900"))  # сколько держим сохранённую сессию портала
+SCREENSHOT_FALLBACK = os.getenv("SCREENSHOT_FALLBACK", "1") != "0"
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", "2"))  # не больше параллельных сессий тарифа Browserless
+SCRAPE_TIMEOUT = float(os.getenv("SCRAPE_TIMEOUT", "45"))  # общий дедлайн на один скрапинг, вместо суммы шаговых таймаутов
 
 LOGIN_URL = "https://klient.gdansk.uw.gov.pl"
 
+# ---------- Patterns ----------
+_RE_COOKIE = re.compile("Akceptuj|Zgadzam|Accept|Zgoda", re.I)
+_RE_CASE = re.compile(r"Numer sprawy", re.I)
+_RE_PASS = re.compile(r"Hasło", re.I)
+_RE_LOGIN_BTN = re.compile(r"Zaloguj|Log in|Zaloguj się", re.I)
+_RE_LOGIN_ERR = re.compile(r"(błędne|nieprawidłow).*hasł|logow|błąd logowania", re.I)
+_RE_WS = re.compile(r"\s+")
+
 # ---------- LOG ----------
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 log = logging.getLogger("bot")
 
 # ---------- helpers ----------
+# Спецсимволы legacy Markdown, которые Telegram позволяет экранировать обратным слэшем
+_MD_ESCAPE = str.maketrans({"_": "\\_", "*": "\\*", "`": "\\`", "[": "\\["})
+
 def safe_markdown(text: str) -> str:
-    return (
-        text.replace("_", "\\_")
-        .replace("*", "\\*")
-        .replace("`", "\\`")
-    )
+    return text.translate(_MD_ESCAPE)
 
-async def safe_edit_or_send(query, text, reply_markup=None, parse_mode="Markdown"):
+async def safe_edit_or_send(query, text, reply_markup=None, parse_mode=None):
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
     except Exception as e:
@@ -61,13 +89,29 @@ async def safe_edit_or_send(query, text, reply_markup=None, parse_mode="Markdown
             await query.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
 
 # ---------- Encryption ----------
+# Новые записи: 0x01 | nonce(12) | AES-256-GCM(шифртекст+тег). Ключ выводится из SECRET_KEY через HKDF.
+# Старые записи — токены Fernet (начинаются с 0x80 в base64, т.е. b"g"), читаем их как раньше;
+# при следующем upsert_creds они перешифровываются в новый формат.
+_AEAD_VERSION = b"\x01"
+_AEAD_NONCE_LEN = 12
+
+@lru_cache(maxsize=1)
 def get_fernet() -> Fernet:
     if not SECRET_KEY:
         raise RuntimeError("SECRET_KEY не задан.")
     return Fernet(SECRET_KEY)
 
+@lru_cache(maxsize=1)
+def get_aead() -> AESGCM:
+    get_fernet()  # та же проверка ключа
+    key = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"tg-uw-status-bot/creds/aesgcm",
+    ).derive(base64.urlsafe_b64decode(SECRET_KEY))
+    return AESGCM(key)
+
 def enc(text: str) -> bytes:
-    return get_fernet().encrypt(text.encode("utf-8"))
+    nonce = os.urandom(_AEAD_NONCE_LEN)
+    return _AEAD_VERSION + nonce + get_aead().encrypt(nonce, text.encode("utf-8"), None)
 
 def dec(blob) -> str:
     if blob is None:
@@ -78,215 +122,655 @@ def dec(blob) -> str:
         blob = bytes(blob)
     elif isinstance(blob, str):
         blob = blob.encode("utf-8")
+    if blob[:1] == _AEAD_VERSION:
+        nonce = blob[1:1 + _AEAD_NONCE_LEN]
+        try:
+            return get_aead().decrypt(nonce, blob[1 + _AEAD_NONCE_LEN:], None).decode("utf-8")
+        except InvalidTag:
+            raise InvalidToken  # для вызывающих — та же ошибка, что и у Fernet
     return get_fernet().decrypt(blob).decode("utf-8")
 
 # ---------- DB ----------
-def db():
+# asyncpg держит кэш prepared statements на каждом соединении пула (ключ — текст запроса),
+# поэтому горячие запросы вынесены в константы: повторные вызовы не парсятся и не планируются заново.
+SQL_GET_CREDS = "select case_enc, pass_enc from users where telegram_id=$1"
+SQL_UPSERT_CREDS = """
+    insert into users(telegram_id, case_enc, pass_enc)
+    values($1, $2, $3)
+    on conflict (telegram_id) do update set
+      case_enc=excluded.case_enc, pass_enc=excluded.pass_enc, updated_at=now();
+"""
+SQL_DELETE_USER = "delete from users where telegram_id=$1"
+
+_POOL: asyncpg.Pool | None = None
+
+async def init_db():
+    global _POOL
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL не задан.")
-    return psycopg2.connect(DATABASE_URL, sslmode="require", cursor_factory=RealDictCursor)
-
-def ensure_schema():
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("""
-            create table if not exists users (
-                telegram_id  bigint primary key,
-                case_enc     bytea not null,
-                pass_enc     bytea not null,
-                alerts       boolean not null default false,
-                created_at   timestamptz not null default now(),
-                updated_at   timestamptz not null default now()
-            );
-        """)
-        conn.commit()
+    _POOL = await asyncpg.create_pool(
+        DATABASE_URL, ssl="require", min_size=PG_POOL_MIN, max_size=PG_POOL_MAX, statement_cache_size=1024,
+    )
+    await ensure_schema()
+
+async def close_db():
+    global _POOL
+    pool, _POOL = _POOL, None
+    if pool is not None:
+        await pool.close()
+
+def db() -> asyncpg.Pool:
+    if _POOL is None:
+        raise RuntimeError("Пул соединений с БД не инициализирован.")
+    return _POOL
+
+# Ключ advisory-lock для миграции: несколько реплик, стартующих одновременно, не гоняют DDL параллельно
+_SCHEMA_LOCK_ID = 7421337
+
+async def ensure_schema():
+    async with db().acquire() as con:
+        # обычный рестарт: таблица уже есть — никакого DDL и блокировок
+        if await con.fetchval("select to_regclass('users')") is not None:
+            return
+        async with con.transaction():
+            await con.execute("select pg_advisory_xact_lock($1)", _SCHEMA_LOCK_ID)
+            await con.execute("""
+                create table if not exists users (
+                    telegram_id  bigint primary key,
+                    case_enc     bytea not null,
+                    pass_enc     bytea not null,
+                    alerts       boolean not null default false,
+                    created_at   timestamptz not null default now(),
+                    updated_at   timestamptz not null default now()
+                );
+            """)
 
 @dataclass
 class Creds:
     case_no: str
     password: str
-    alerts: bool  # для совместимости, не используем
 
-def get_creds(telegram_id: int) -> Creds | None:
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("select case_enc, pass_enc, alerts from users where telegram_id=%s", (telegram_id,))
-        row = cur.fetchone()
+async def get_creds(telegram_id: int) -> Creds | None:
+    async with db().acquire() as con:
+        row = await con.fetchrow(SQL_GET_CREDS, telegram_id)
         if not row:
             return None
         try:
-            return Creds(dec(row["case_enc"]), dec(row["pass_enc"]), row["alerts"])
+            return Creds(dec(row["case_enc"]), dec(row["pass_enc"]))
         except InvalidToken:
             return None
 
-def upsert_creds(telegram_id: int, case_no: str, password: str):
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("""
-            insert into users(telegram_id, case_enc, pass_enc)
-            values(%s, %s, %s)
-            on conflict (telegram_id) do update set
-              case_enc=excluded.case_enc, pass_enc=excluded.pass_enc, updated_at=now();
-        """, (telegram_id, enc(case_no), enc(password)))
-        conn.commit()
-
-def delete_user(telegram_id: int):
-    with db() as conn, conn.cursor() as cur:
-        cur.execute("delete from users where telegram_id=%s", (telegram_id,))
-        conn.commit()
+async def upsert_creds(telegram_id: int, case_no: str, password: str):
+    async with db().acquire() as con:
+        await con.execute(SQL_UPSERT_CREDS, telegram_id, enc(case_no), enc(password))
+
+async def delete_user(telegram_id: int):
+    async with db().acquire() as con:
+        await con.execute(SQL_DELETE_USER, telegram_id)
 
 # ---------- Scraper helpers ----------
-async def _fill_first_that_works(page, locators_factories, value: str):
-    last_err = None
-    for lf in locators_factories:
-        try:
-            await lf().fill(value, timeout=3000)
-            return
-        except Exception as e:
-            last_err = e
-    raise RuntimeError("Не нашёл поле ввода. Детали: " + str(last_err))
+# Запасные варианты каждого поля объединены в один локатор (get_by_label | CSS-объединение):
+# Playwright ищет их одним запросом, а не перебирает по очереди с таймаутом на каждый.
+_SEL_CASE = ("input[aria-label*='Numer sprawy' i], input[placeholder*='Numer sprawy' i], "
+             "input[name*='numer' i], input[id*='numer' i]")
+_SEL_PASS = "input[type='password'], input[aria-label*='Hasło' i], input[placeholder*='Hasło' i]"
+_SEL_SUBMIT = "button[type='submit'], input[type='submit']"
 
-async def _click_first_that_works(page, locators_factories):
-    last_err = None
-    for lf in locators_factories:
-        try:
-            await lf().click(timeout=3000)
-            return
-        except Exception as e:
-            last_err = e
-    raise RuntimeError("Не получилось нажать кнопку входа. Детали: " + str(last_err))
+def _case_field(page):
+    return page.get_by_label(_RE_CASE).or_(page.locator(_SEL_CASE)).first
+
+def _pass_field(page):
+    return page.get_by_label(_RE_PASS).or_(page.locator(_SEL_PASS)).first
+
+def _submit_button(page):
+    return page.get_by_role("button", name=_RE_LOGIN_BTN).or_(page.locator(_SEL_SUBMIT)).first
+
+async def _fill(locator, value: str):
+    try:
+        await locator.fill(value, timeout=5000)
+    except Exception as e:
+        raise RuntimeError("Не нашёл поле ввода. Детали: " + str(e))
+
+async def _click(locator):
+    try:
+        await locator.click(timeout=5000)
+    except Exception as e:
+        raise RuntimeError("Не получилось нажать кнопку входа. Детали: " + str(e))
+
+# --- Вход одним evaluate(): ищем поля и кнопку в браузере, без лишних CDP round-trip'ов ---
+# Возвращает true, если поля заполнены и кнопка нажата; null — если что-то не нашлось
+# (тогда работает обычная цепочка локаторов Playwright).
+_JS_LOGIN = """
+({case_no, password}) => {
+  const norm = s => (s || "")
+    .toString()
+    .normalize("NFKD")
+    .replace(/[\\u0300-\\u036f]/g,"")
+    .toLowerCase()
+    .replace(/ł/g,"l")
+    .replace(/\\s+/g," ")
+    .trim();
+
+  const describe = el => {
+    const parts = [
+      el.getAttribute("aria-label"), el.getAttribute("placeholder"), el.getAttribute("label"),
+      el.getAttribute("name"), el.id,
+    ];
+    if (el.labels) for (const lb of el.labels) parts.push(lb.textContent);
+    const host = el.closest("vaadin-text-field,vaadin-password-field");
+    if (host && host !== el) parts.push(host.getAttribute("label"), host.textContent);
+    return norm(parts.filter(Boolean).join(" "));
+  };
+
+  const fields = Array.from(document.querySelectorAll(
+    "vaadin-text-field,vaadin-password-field,input:not([type=hidden]):not([type=submit]):not([type=button])"
+  ));
+  const isPass = el => el.localName === "vaadin-password-field" || el.type === "password" || describe(el).includes("haslo");
+  const pass = fields.find(isPass);
+  const caseField = fields.find(el => !isPass(el) && describe(el).includes("numer"));
+
+  const buttons = Array.from(document.querySelectorAll("vaadin-button,button,input[type=submit]"));
+  const submit = buttons.find(b => /zaloguj|log in/.test(norm(b.textContent || b.value)))
+              || buttons.find(b => b.type === "submit");
+  if (!pass || !caseField || !submit) return null;
+
+  const setValue = (el, v) => {
+    if (el instanceof HTMLInputElement) {
+      Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, "value").set.call(el, v);
+    } else {
+      el.value = v;
+    }
+    el.dispatchEvent(new Event("input", {bubbles: true, composed: true}));
+    el.dispatchEvent(new Event("change", {bubbles: true, composed: true}));
+  };
+  setValue(caseField, case_no);
+  setValue(pass, password);
+  submit.click();
+  return true;
+}
+"""
+
+async def _login_via_js(page, case_no: str, password: str) -> bool:
+    with suppress(Exception):
+        return bool(await page.evaluate(_JS_LOGIN, {"case_no": case_no, "password": password}))
+    return False
 
 # --- Парсер Vaadin-страницы: берём value у vaadin-text-field рядом с меткой ---
-async def _status_from_frame(frame: Frame) -> str | None:
-    js = """
-    () => {
-      const norm = s => (s || "")
-        .toString()
-        .normalize("NFKD")
-        .replace(/[\\u0300-\\u036f]/g,"")
-        .toLowerCase()
-        .replace(/\\s+/g," ")
-        .trim();
-
-      const labelsWanted = ["etap postepowania","status sprawy","stage of proceedings"];
-
-      const labels = Array.from(document.querySelectorAll("label"));
-      for (const lb of labels) {
-        const t = norm(lb.innerText);
-        if (!labelsWanted.some(w => t.includes(w))) continue;
-
-        const row = lb.closest("div")?.parentElement || lb.parentElement || document.body;
-        const sel = "vaadin-text-field,vaadin-text-area,input,textarea,select,[value]";
-        const candidates = Array.from(row.querySelectorAll(sel));
-
-        let sib = lb.parentElement;
-        for (let i=0; i<4 && sib; i++) {
-          sib = sib.nextElementSibling;
-          if (sib) candidates.push(...sib.querySelectorAll(sel));
-        }
-
-        for (const el of candidates) {
-          let v = "";
-          if ("value" in el) v = el.value || "";
-          if (!v && el.getAttribute) v = el.getAttribute("value") || "";
-          if (!v) v = (el.textContent || "");
-          v = v.replace(/\\s+/g," ").trim();
-          if (v) return v;
-        }
-      }
-
-      const textNodes = Array.from(document.querySelectorAll("*"))
-        .filter(n => labelsWanted.some(w => norm(n.textContent).includes(w)));
-      for (const n of textNodes) {
-        const sel = "vaadin-text-field,vaadin-text-area,input,textarea,select,[value]";
-        const field = n.parentElement?.querySelector(sel)
-                  || n.closest("div")?.querySelector(sel)
-                  || n.ownerDocument.querySelector(sel);
-        if (field) {
-          let v = ("value" in field ? field.value : "") || field.getAttribute?.("value") || "";
-          v = (v || field.textContent || "").replace(/\\s+/g," ").trim();
-          if (v) return v;
-        }
-      }
-      return null;
+# Скрипт ставится один раз на контекст через add_init_script и есть в каждом фрейме,
+# поэтому на каждый фрейм по CDP уходит только короткий вызов, а не весь исходник.
+_JS_STATUS = """
+window.__getStatus = () => {
+  const norm = s => (s || "")
+    .toString()
+    .normalize("NFKD")
+    .replace(/[\\u0300-\\u036f]/g,"")
+    .toLowerCase()
+    .replace(/\\s+/g," ")
+    .trim();
+
+  const labelsWanted = ["etap postepowania","status sprawy","stage of proceedings"];
+
+  const labels = Array.from(document.querySelectorAll("label"));
+  for (const lb of labels) {
+    const t = norm(lb.textContent);
+    if (!labelsWanted.some(w => t.includes(w))) continue;
+
+    const row = lb.closest("div")?.parentElement || lb.parentElement || document.body;
+    const sel = "vaadin-text-field,vaadin-text-area,input,textarea,select,[value]";
+    const candidates = Array.from(row.querySelectorAll(sel));
+
+    let sib = lb.parentElement;
+    for (let i=0; i<4 && sib; i++) {
+      sib = sib.nextElementSibling;
+      if (sib) candidates.push(...sib.querySelectorAll(sel));
+    }
+
+    for (const el of candidates) {
+      let v = "";
+      if ("value" in el) v = el.value || "";
+      if (!v && el.getAttribute) v = el.getAttribute("value") || "";
+      if (!v) v = (el.textContent || "");
+      v = v.replace(/\\s+/g," ").trim();
+      if (v) return v;
+    }
+  }
+
+  // запасной путь: ограниченный набор «листовых» элементов вместо обхода всего DOM через "*"
+  const textNodes = Array.from(document.querySelectorAll("td,th,dt,span,vaadin-form-item"))
+    .filter(n => (n.textContent || "").length < 200 && labelsWanted.some(w => norm(n.textContent).includes(w)));
+  for (const n of textNodes) {
+    const sel = "vaadin-text-field,vaadin-text-area,input,textarea,select,[value]";
+    const field = n.parentElement?.querySelector(sel)
+              || n.closest("div")?.querySelector(sel)
+              || n.ownerDocument.querySelector(sel);
+    if (field) {
+      let v = ("value" in field ? field.value : "") || field.getAttribute?.("value") || "";
+      v = (v || field.textContent || "").replace(/\\s+/g," ").trim();
+      if (v) return v;
     }
-    """
+  }
+  return null;
+};
+"""
+_JS_CALL_STATUS = "() => window.__getStatus ? window.__getStatus() : null"
+
+# Ждём появления метки «Etap post…» по MutationObserver: один вызов CDP вместо опроса локатором
+_JS_WAIT_STATUS_LABEL = """
+(timeout) => new Promise(resolve => {
+  const has = root => Array.from(root.querySelectorAll("label"))
+    .some(l => (l.textContent || "").includes("Etap post"));
+  // как и локатор label:has-text, заглядываем в открытые shadowRoot: мутации внутри них observer на document
+  // не видит, а полный обход дорогой — поэтому он по таймеру, а не на каждую мутацию
+  const deep = root => has(root) || Array.from(root.querySelectorAll("*"))
+    .some(el => el.shadowRoot && deep(el.shadowRoot));
+  if (deep(document)) return resolve(true);
+  const done = ok => { mo.disconnect(); clearInterval(poll); clearTimeout(timer); resolve(ok); };
+  const mo = new MutationObserver(() => { if (has(document)) done(true); });
+  const poll = setInterval(() => { if (deep(document)) done(true); }, 500);
+  const timer = setTimeout(() => done(false), timeout);
+  mo.observe(document, {subtree: true, childList: true, characterData: true});
+})
+"""
+
+# Барьер после goto: "status" — сессия жива и мы уже внутри, "login" — отрисована форма входа
+_JS_WAIT_PAGE_STATE = """
+(timeout) => new Promise(resolve => {
+  const state = () => {
+    if (Array.from(document.querySelectorAll("label")).some(l => (l.textContent || "").includes("Etap post"))) return "status";
+    if (document.querySelector("input[type=password],vaadin-password-field")) return "login";
+    return null;
+  };
+  const now = state();
+  if (now) return resolve(now);
+  const mo = new MutationObserver(() => {
+    const s = state();
+    if (s) { mo.disconnect(); clearTimeout(timer); resolve(s); }
+  });
+  const timer = setTimeout(() => { mo.disconnect(); resolve(null); }, timeout);
+  mo.observe(document, {subtree: true, childList: true, characterData: true});
+})
+"""
+
+async def _status_from_frame(frame: Frame) -> str | None:
     with suppress(Exception):
-        txt = await frame.evaluate(js)
+        txt = await frame.evaluate(_JS_CALL_STATUS)
         if txt:
-            return re.sub(r"\s+", " ", txt).strip()
+            return _RE_WS.sub(" ", txt).strip()
     return None
 
-# ---------- Scraper ----------
-async def fetch_status(case_no: str, password: str) -> str | tuple[str, bytes]:
+# ---------- Browser ----------
+# Одно CDP-подключение к Browserless на весь процесс; на каждый запрос — свой BrowserContext.
+_PW = None
+_BROWSER = None
+_BROWSER_LOCK = asyncio.Lock()
+_PING_TASK: asyncio.Task | None = None
+_BROWSER_BUSY = 0
+_BROWSER_LAST_USED = 0.0
+_BROWSER_CONNECTED_AT = 0.0
+_RETIRED_BROWSERS: set[asyncio.Task] = set()  # отложенные закрытия отставленных подключений
+
+def _browserless_url() -> str:
+    # keepalive: Browserless держит сессию между запросами, а не закрывает её после отключения страницы;
+    # timeout — это максимальная длительность сессии, а не простой, поэтому он задаётся отдельно
+    parts = urlsplit(BROWSERLESS_WS)
+    query = dict(parse_qsl(parts.query))
+    query.setdefault("keepalive", str(BROWSERLESS_KEEPALIVE_MS))
+    if BROWSERLESS_SESSION_TIMEOUT_MS:
+        query.setdefault("timeout", str(BROWSERLESS_SESSION_TIMEOUT_MS))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+async def _ping_browser(browser):
+    # Лёгкий CDP-запрос раз в BROWSER_PING_INTERVAL, чтобы WebSocket не закрывался по простою
+    cdp = None
+    while browser.is_connected() and _BROWSER is browser:
+        await asyncio.sleep(BROWSER_PING_INTERVAL)
+        if not _BROWSER_BUSY and time.monotonic() - _BROWSER_LAST_USED > BROWSER_IDLE_TTL:
+            if await _release_idle_browser(browser):
+                return
+            continue
+        try:
+            if cdp is None:
+                cdp = await browser.new_browser_cdp_session()
+            await cdp.send("Browser.getVersion")
+        except Exception as e:
+            if browser.is_connected():
+                # сокет жив, а CDP не отвечает: без пинга сессию никто не отпустит — уходим на новое подключение
+                _retire_browser(browser, "Удалённый браузер не ответил на пинг (%s), переподключусь.", e)
+            return
+
+async def _release_idle_browser(browser) -> bool:
+    # Browserless тарифицирует время сессии: без проверок дольше BROWSER_IDLE_TTL соединение закрываем,
+    # следующий get_browser() подключится заново
+    global _BROWSER, _PING_TASK
+    async with _BROWSER_LOCK:
+        if _BROWSER is not browser or _BROWSER_BUSY:
+            return False
+        _BROWSER, _PING_TASK = None, None
+    log.info("Удалённый браузер простаивает дольше %.0f сек., отключаюсь.", BROWSER_IDLE_TTL)
+    with suppress(Exception):
+        await browser.close()
+    return True
+
+async def _close_browser_later(browser, delay: float):
+    await asyncio.sleep(delay)
+    with suppress(Exception):
+        await browser.close()
+
+def _retire_browser(browser, reason: str, *args, level: int = logging.WARNING):
+    # Новые проверки сразу идут на свежее подключение; это закрываем, когда начатые на нём проверки
+    # гарантированно уложились в SCRAPE_TIMEOUT
+    global _BROWSER, _PING_TASK
+    if _BROWSER is not browser:
+        return
+    task, _BROWSER, _PING_TASK = _PING_TASK, None, None
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+    log.log(level, reason, *args)
+    closer = asyncio.create_task(_close_browser_later(browser, SCRAPE_TIMEOUT if _BROWSER_BUSY else 0))
+    _RETIRED_BROWSERS.add(closer)
+    closer.add_done_callback(_RETIRED_BROWSERS.discard)
+
+def _on_browser_disconnected(browser):
+    global _BROWSER
+    if _BROWSER is browser:
+        log.warning("Соединение с удалённым браузером потеряно, переподключусь при следующем запросе.")
+        _BROWSER = None
+
+async def get_browser():
+    global _PW, _BROWSER, _PING_TASK, _BROWSER_LAST_USED, _BROWSER_CONNECTED_AT
     if not BROWSERLESS_WS:
         raise RuntimeError("BROWSERLESS_WS не задан.")
-
-    async with async_playwright() as p:
+    async with _BROWSER_LOCK:
+        if _BROWSER is not None and _BROWSER.is_connected():
+            return _BROWSER
+        if _PW is None:
+            _PW = await async_playwright().start()
         try:
-            browser = await p.chromium.connect_over_cdp(BROWSERLESS_WS)
+            browser = await _PW.chromium.connect_over_cdp(_browserless_url())
         except Exception as e:
             raise RuntimeError("Не удаётся подключиться к удалённому браузеру: " + str(e))
+        browser.on("disconnected", _on_browser_disconnected)
+        _BROWSER = browser
+        _BROWSER_CONNECTED_AT = time.monotonic()
+        _BROWSER_LAST_USED = _BROWSER_CONNECTED_AT  # отсчёт простоя — с подключения, иначе прогретый браузер отпустится первым же пингом
+        _PING_TASK = asyncio.create_task(_ping_browser(browser))
+        return browser
+
+async def close_browser():
+    global _PW, _BROWSER, _PING_TASK
+    async with _BROWSER_LOCK:
+        task, _PING_TASK = _PING_TASK, None
+        if task is not None:
+            task.cancel()
+        for closer in list(_RETIRED_BROWSERS):
+            closer.cancel()  # отставленные подключения закроются вместе с Playwright ниже
+        browser, _BROWSER = _BROWSER, None
+        if browser is not None:
+            with suppress(Exception):
+                await browser.close()
+        pw, _PW = _PW, None
+        if pw is not None:
+            with suppress(Exception):
+                await pw.stop()
+
+@asynccontextmanager
+async def browser_context(**kwargs):
+    """Свежий BrowserContext на общем браузере; пока он открыт, браузер не считается простаивающим."""
+    global _BROWSER_BUSY, _BROWSER_LAST_USED
+    # проверка, начатая сейчас, должна уложиться в SCRAPE_TIMEOUT до ?timeout= — иначе берём свежее подключение
+    if (_BROWSER is not None and BROWSERLESS_SESSION_TIMEOUT_MS
+            and time.monotonic() - _BROWSER_CONNECTED_AT > BROWSERLESS_SESSION_TIMEOUT_MS / 1000 - 2 * SCRAPE_TIMEOUT):
+        _retire_browser(_BROWSER, "Сессия Browserless подходит к пределу timeout, переподключаюсь.", level=logging.INFO)
+    browser = await get_browser()
+    _BROWSER_BUSY += 1
+    try:
+        try:
+            context = await browser.new_context(**kwargs)
+        except PlaywrightError:
+            if browser.is_connected():
+                raise
+            # сессия Browserless умерла раньше, чем пришло событие disconnected — переподключаемся один раз
+            _on_browser_disconnected(browser)
+            browser = await get_browser()
+            context = await browser.new_context(**kwargs)
+        try:
+            yield context
+        finally:
+            await context.close()
+    finally:
+        _BROWSER_BUSY -= 1
+        _BROWSER_LAST_USED = time.monotonic()
 
-        context = await browser.new_context(
-            locale="pl-PL",
-            user_agent=("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123 Safari/537.36"),
-            ignore_https_errors=True,
-        )
-        page = await context.new_page()
+# ---------- Scraper ----------
+ERR_LOGIN = "Błąd logowania: sprawdź numer sprawy i hasło."
+ERR_NO_STATUS = "Не нашёл текст статуса на странице. Попробуй ещё раз позже."
+ERR_PORTAL_SLOW = "Портал не отвечает или работает медленно. Попробуйте позже."
 
-        try:
-            await page.goto(LOGIN_URL, wait_until="domcontentloaded", timeout=45000)
+# Для скрапинга нужны только поля формы и один текст: картинки, шрифты, медиа, субтитры и манифесты не грузим.
+# Стили оставляем — от них зависит видимость меток во Vaadin.
+_BLOCKED_RESOURCES = frozenset({"image", "media", "font", "texttrack", "manifest"})
 
-            with suppress(Exception):
-                await page.get_by_role("button", name=re.compile("Akceptuj|Zgadzam|Accept|Zgoda", re.I)).click(timeout=2000)
+async def _route_filter(route):
+    if route.request.resource_type in _BLOCKED_RESOURCES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+# Сохранённые после входа cookies/localStorage портала (Playwright storage_state) по ключу дела:
+# пока сессия Vaadin жива, следующая проверка открывает страницу статуса сразу, без формы входа.
+_SESSIONS: dict[str, tuple[float, dict]] = {}
 
-            await _fill_first_that_works(page, [
-                lambda: page.get_by_label(re.compile(r"Numer sprawy", re.I)),
-                lambda: page.locator("input[name*='numer' i], input[id*='numer' i]"),
-            ], case_no)
+async def _login(page, case_no: str, password: str):
+    if not await _login_via_js(page, case_no, password):
+        # fill — это focus + insertText, параллельно поля перепутаются
+        await _fill(_case_field(page), case_no)
+        await _fill(_pass_field(page), password)
+        await _click(_submit_button(page))
 
-            await _fill_first_that_works(page, [
-                lambda: page.get_by_label(re.compile(r"Hasło", re.I)),
-                lambda: page.locator("input[type='password']"),
-            ], password)
+    try:
+        await page.evaluate(_JS_WAIT_STATUS_LABEL, 15000)
+    except Exception:
+        # навигация после входа рвёт контекст исполнения вместе с observer'ом — ждём метку локатором
+        with suppress(Exception):
+            await page.locator("label:has-text('Etap post')").first.wait_for(timeout=15000)
 
-            await _click_first_that_works(page, [
-                lambda: page.get_by_role("button", name=re.compile(r"Zaloguj|Log in|Zaloguj się", re.I)),
-                lambda: page.locator("button[type='submit'],input[type='submit']"),
-            ])
+    err = None
+    with suppress(Exception):
+        err = await page.get_by_text(_RE_LOGIN_ERR).inner_text(timeout=1500)
+    if err:
+        raise RuntimeError(ERR_LOGIN)
+
+async def fetch_status(case_no: str, password: str) -> str | tuple[str, bytes]:
+    key = _status_key(case_no, password)
+    saved = _SESSIONS.pop(key, None)
+    session = saved[1] if saved and time.monotonic() - saved[0] < PORTAL_SESSION_TTL else None
+    async with browser_context(
+        locale="pl-PL",
+        user_agent=("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123 Safari/537.36"),
+        ignore_https_errors=True,
+        viewport={"width": 800, "height": 600},  # меньше площадь раскладки и скриншота
+        storage_state=session,
+    ) as context:
+        try:
+            await context.add_init_script(_JS_STATUS)
+            await context.route("**/*", _route_filter)
+            page = await context.new_page()
+            # "commit": не ждём разбора всей страницы — реальный барьер ниже, по появлению формы или статуса
+            await page.goto(LOGIN_URL, wait_until="commit", timeout=20000)
 
-            await page.wait_for_load_state("domcontentloaded", timeout=45000)
+            state = None
             with suppress(Exception):
-                await page.locator("label:has-text('Etap post')").first.wait_for(timeout=15000)
+                state = await page.evaluate(_JS_WAIT_PAGE_STATE, 15000)
 
             with suppress(Exception):
-                err = await page.get_by_text(re.compile(r"(błędne|nieprawidłow).*hasł|logow|błąd logowania", re.I)).inner_text(timeout=1500)
-                if err:
-                    raise RuntimeError("Błąd logowania: sprawdź numer sprawy и hasło.")
+                await page.get_by_role("button", name=_RE_COOKIE).click(timeout=2000)
 
-            status = await _status_from_frame(page.main_frame)
-            if status:
-                return status
+            if session is None or state != "status":
+                # сессии нет, она истекла (портал показал форму входа) или страница не распозналась
+                await _login(page, case_no, password)
 
-            for fr in page.frames:
-                if fr is page.main_frame:
-                    continue
+            # все фреймы опрашиваем параллельно; page.frames начинается с main_frame, он в приоритете
+            results = await asyncio.gather(*(_status_from_frame(fr) for fr in page.frames), return_exceptions=True)
+            status = next((r for r in results if isinstance(r, str) and r), None)
+            if status:
                 with suppress(Exception):
-                    status = await _status_from_frame(fr)
-                    if status:
-                        return status
+                    _SESSIONS[key] = (time.monotonic(), await context.storage_state())
+                return status
 
-            img = await page.screenshot(full_page=True)
+            if not SCREENSHOT_FALLBACK:
+                raise RuntimeError(ERR_NO_STATUS)
+            img = await page.screenshot(full_page=True, type="jpeg", quality=70)
             return ("screenshot", img)
 
         except PlaywrightTimeout:
-            raise RuntimeError("Портал не отвечает или работает медленно. Попробуйте позже.")
+            raise RuntimeError(ERR_PORTAL_SLOW)
+
+# ---------- Очередь скрапинга ----------
+# Хэндлеры не ходят в браузер сами: кладут задание в очередь и ждут future.
+# Число одновременных сессий Browserless ограничено числом воркеров.
+_SCRAPE_QUEUE: asyncio.Queue | None = None
+_SCRAPE_WORKERS: list[asyncio.Task] = []
+
+async def _scrape_worker():
+    while True:
+        case_no, password, fut = await _SCRAPE_QUEUE.get()
+        try:
+            if fut.done():  # ожидающий уже ушёл по таймауту
+                continue
+            try:
+                # по дедлайну задача отменяется, контекст закрывается и воркер сразу берёт следующее задание
+                res = await asyncio.wait_for(fetch_status(case_no, password), timeout=SCRAPE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if not fut.done():
+                    fut.set_exception(RuntimeError(ERR_PORTAL_SLOW))
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(res)
         finally:
-            await context.close()
+            _SCRAPE_QUEUE.task_done()
+
+def start_scrape_workers():
+    global _SCRAPE_QUEUE
+    _SCRAPE_QUEUE = asyncio.Queue()
+    _SCRAPE_WORKERS[:] = [asyncio.create_task(_scrape_worker()) for _ in range(max(1, SCRAPE_WORKERS))]
+
+async def stop_scrape_workers():
+    for task in _SCRAPE_WORKERS:
+        task.cancel()
+    await asyncio.gather(*_SCRAPE_WORKERS, return_exceptions=True)
+    _SCRAPE_WORKERS.clear()
+
+async def dispatch_scrape(case_no: str, password: str) -> str | tuple[str, bytes]:
+    if _SCRAPE_QUEUE is None:
+        raise RuntimeError("Очередь скрапинга не запущена.")
+    fut = asyncio.get_running_loop().create_future()
+    await _SCRAPE_QUEUE.put((case_no, password, fut))
+    try:
+        return await fut
+    except asyncio.CancelledError:
+        fut.cancel()  # воркер пропустит задание, если ещё не взял его
+        raise
+
+# ---------- Дедупликация проверок ----------
+# Одновременные проверки одного и того же дела (двойной тап, общие данные) ждут одну сессию браузера.
+_INFLIGHT: dict[str, asyncio.Task] = {}
+_INFLIGHT_WAITERS: dict[str, int] = {}
+
+def _status_key(case_no: str, password: str) -> str:
+    # пароль в ключ только в виде хэша: в памяти не лежит открытым текстом
+    return hashlib.blake2b(f"{case_no}\0{password}".encode("utf-8"), digest_size=16).hexdigest()
+
+def _forget_inflight(key: str, task: asyncio.Task):
+    if _INFLIGHT.get(key) is task:
+        del _INFLIGHT[key]
+    if not task.cancelled():
+        task.exception()  # помечаем как прочитанное, если все ожидающие уже отвалились
+
+async def fetch_status_shared(case_no: str, password: str) -> str | tuple[str, bytes]:
+    key = _status_key(case_no, password)
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(dispatch_scrape(case_no, password))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _forget_inflight(key, t))
+    # shield: таймаут одного ожидающего не отменяет проверку для остальных
+    _INFLIGHT_WAITERS[key] = _INFLIGHT_WAITERS.get(key, 0) + 1
+    try:
+        return await asyncio.shield(task)
+    finally:
+        left = _INFLIGHT_WAITERS.pop(key) - 1
+        if left:
+            _INFLIGHT_WAITERS[key] = left
+        elif not task.done():
+            # ушёл последний ожидающий — задание из очереди снимаем, новый вызов начнёт заново
+            _INFLIGHT.pop(key, None)
+            task.cancel()
+
+# ---------- Кэш статусов ----------
+# Etap postępowania меняется от силы пару раз в день — повторные нажатия в пределах TTL
+# отдаём из памяти без сессии Browserless. Скриншоты не кэшируем.
+_STATUS_CACHE: dict[str, tuple[float, str]] = {}
+_STATUS_CACHE_SWEPT = 0.0
+
+def _evict_expired_statuses():
+    # протухшие записи выкидываем не чаще раза за TTL, чтобы словарь не рос на разовых пользователях
+    global _STATUS_CACHE_SWEPT
+    now = time.monotonic()
+    if now - _STATUS_CACHE_SWEPT < STATUS_CACHE_TTL:
+        return
+    _STATUS_CACHE_SWEPT = now
+    for k in [k for k, (ts, _) in _STATUS_CACHE.items() if now - ts >= STATUS_CACHE_TTL]:
+        del _STATUS_CACHE[k]
+    # сохранённые сессии портала тем же проходом: иначе копятся по паре cookies на каждое дело
+    for k in [k for k, (ts, _) in _SESSIONS.items() if now - ts >= PORTAL_SESSION_TTL]:
+        del _SESSIONS[k]
+
+async def get_status(case_no: str, password: str, force: bool = False) -> tuple[str | tuple[str, bytes], float | None]:
+    """Возвращает (результат, возраст кэша в секундах или None, если только что с портала)."""
+    key = _status_key(case_no, password)
+    if not force:
+        hit = _STATUS_CACHE.get(key)
+        if hit and time.monotonic() - hit[0] < STATUS_CACHE_TTL:
+            return hit[1], time.monotonic() - hit[0]
+    res = await fetch_status_shared(case_no, password)
+    if isinstance(res, str):
+        _evict_expired_statuses()
+        _STATUS_CACHE[key] = (time.monotonic(), res)
+    return res, None
+
+def forget_status(case_no: str, password: str):
+    """Забыть кэш статуса и сессию портала для этих данных (после удаления/смены)."""
+    key = _status_key(case_no, password)
+    _STATUS_CACHE.pop(key, None)
+    _SESSIONS.pop(key, None)
 
 # ---------- UI ----------
 AWAIT_CASE, AWAIT_PASS = range(2)
 
-def main_kb(has_creds: bool) -> InlineKeyboardMarkup:
+MSG_HELLO = (
+    "Привет! Я помогу отслеживать статус твоего дела на портале Гданьского воеводы.\n\n"
+    "• Нажми «🔑 Подключить дело», чтобы один раз сохранить *Numer sprawy* и *Hasło*.\n"
+    "• Дальше жми «🔍 Проверить статус» — пришлю *Etap postępowania*.\n"
+    "• Данные шифруются, их можно удалить одной кнопкой."
+)
+MSG_ASK_CASE = "Введи *номер дела* (Numer sprawy):"
+MSG_ASK_PASS = "Принято. Теперь отправь *пароль* (Hasło):"
+MSG_NEED_CONNECT = "Сначала подключи дело: нажми «🔑 Подключить дело»."
+MSG_CHECKING = "⏳ Проверяю статус..."
+MSG_SCREENSHOT = "Не нашёл текст статуса — отправляю скриншот страницы ниже."
+MSG_STATUS = "📌 Etap postępowania: *{status}*"
+MSG_STATUS_CACHED = MSG_STATUS + "\n_Проверено {age} сек. назад._"
+MSG_TIMEOUT = "⚠️ Сайт не ответил за 55 сек. Попробуй ещё раз позже."
+MSG_UNLINKED = "Данные удалены. Нажми «🔑 Подключить дело», чтобы добавить заново."
+MSG_RESTART = "Что-то пошло не так. Нажми «🔑 Подключить дело» и начни заново."
+MSG_SAVED = "Готово! Данные сохранены.\nТеперь просто жми «🔍 Проверить статус»."
+MSG_CANCELLED = "Окей, отменил."
+
+def _build_main_kb(has_creds: bool) -> InlineKeyboardMarkup:
     rows = []
     if has_creds:
         rows.append([InlineKeyboardButton("🔍 Проверить статус", callback_data="check")])
@@ -296,82 +780,114 @@ def main_kb(has_creds: bool) -> InlineKeyboardMarkup:
         rows.append([InlineKeyboardButton("🔑 Подключить дело", callback_data="connect")])
     return InlineKeyboardMarkup(rows)
 
+# Клавиатуры неизменяемы (объекты PTB заморожены) — строим один раз и переиспользуем
+_KB_NOCREDS = _build_main_kb(False)
+_KB_CREDS = _build_main_kb(True)
+_KB_CACHED_STATUS = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🔄 Обновить с портала", callback_data="refresh")]] + list(_KB_CREDS.inline_keyboard)
+)
+
+def main_kb(has_creds: bool) -> InlineKeyboardMarkup:
+    return _KB_CREDS if has_creds else _KB_NOCREDS
+
+def cached_status_kb() -> InlineKeyboardMarkup:
+    return _KB_CACHED_STATUS
+
+async def load_creds(context: ContextTypes.DEFAULT_TYPE, uid: int) -> Creds | None:
+    # user_data живёт в памяти процесса: повторные нажатия кнопок не ходят в БД
+    creds = context.user_data.get("creds")
+    if creds is None:
+        creds = await get_creds(uid)
+        if creds:
+            context.user_data["creds"] = creds
+    return creds
+
 async def greet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    creds = get_creds(uid)
-    text = (
-        "Привет! Я помогу отслеживать статус твоего дела на портале Гданьского воеводы.\n\n"
-        "• Нажми «🔑 Подключить дело», чтобы один раз сохранить *Numer sprawy* и *Hasło*.\n"
-        "• Дальше жми «🔍 Проверить статус» — пришлю *Etap postępowania*.\n"
-        "• Данные шифруются, их можно удалить одной кнопкой."
-    )
-    await update.message.reply_text(text, parse_mode="Markdown",
+    creds = await load_creds(context, uid)
+    await update.message.reply_text(MSG_HELLO, parse_mode="Markdown",
         reply_markup=main_kb(bool(creds)))
 
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    uid = query.from_user.id
-    data = query.data
-
-    if data == "connect":
-        context.user_data["connect"] = {}
-        await safe_edit_or_send(query, "Введи *номер дела* (Numer sprawy):", parse_mode="Markdown")
-        return AWAIT_CASE
-
-    if data == "check":
-        creds = get_creds(uid)
-        if not creds:
+async def _run_check(query, creds: Creds, force: bool):
+    try:
+        res, age = await asyncio.wait_for(get_status(creds.case_no, creds.password, force=force), timeout=55)
+        if isinstance(res, tuple) and res[0] == "screenshot":
+            await safe_edit_or_send(query, MSG_SCREENSHOT, reply_markup=main_kb(True))
+            with suppress(Exception):
+                await query.message.reply_photo(InputFile(res[1], filename="status.jpg"))
+        elif age is not None:
             await safe_edit_or_send(
                 query,
-                "Сначала подключи дело: нажми «🔑 Подключить дело».",
-                reply_markup=main_kb(False),
+                MSG_STATUS_CACHED.format(status=safe_markdown(res), age=int(age)),
+                parse_mode="Markdown",
+                reply_markup=cached_status_kb(),
             )
-            return ConversationHandler.END
-
-        await safe_edit_or_send(query, "⏳ Проверяю статус...")
-        try:
-            res = await asyncio.wait_for(fetch_status(creds.case_no, creds.password), timeout=55)
-            if isinstance(res, tuple) and res[0] == "screenshot":
-                await safe_edit_or_send(
-                    query,
-                    "Не нашёл текст статуса — отправляю скриншот страницы ниже.",
-                    reply_markup=main_kb(True),
-                )
-                with suppress(Exception):
-                    await query.message.reply_photo(InputFile(io.BytesIO(res[1]), filename="status.png"))
-            else:
-                await safe_edit_or_send(
-                    query,
-                    f"📌 Etap postępowania: *{safe_markdown(res)}*",
-                    parse_mode="Markdown",
-                    reply_markup=main_kb(True),
-                )
-        except asyncio.TimeoutError:
+        else:
             await safe_edit_or_send(
                 query,
-                "⚠️ Сайт не ответил за 55 сек. Попробуй ещё раз позже.",
+                MSG_STATUS.format(status=safe_markdown(res)),
+                parse_mode="Markdown",
                 reply_markup=main_kb(True),
             )
-        except Exception as e:
-            await safe_edit_or_send(query, f"⚠️ {e}", reply_markup=main_kb(True))
-        return ConversationHandler.END
+    except asyncio.TimeoutError:
+        await safe_edit_or_send(query, MSG_TIMEOUT, reply_markup=main_kb(True))
+    except Exception as e:
+        await safe_edit_or_send(query, f"⚠️ {e}", reply_markup=main_kb(True))
+
+async def _on_connect(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    context.user_data.pop("creds", None)
+    context.user_data["connect"] = {}
+    await safe_edit_or_send(query, MSG_ASK_CASE, parse_mode="Markdown")
+    return AWAIT_CASE
 
-    if data == "unlink":
-        delete_user(uid)
-        await safe_edit_or_send(
-            query,
-            "Данные удалены. Нажми «🔑 Подключить дело», чтобы добавить заново.",
-            reply_markup=main_kb(False),
-        )
+async def _on_check(update: Update, context: ContextTypes.DEFAULT_TYPE, force: bool = False):
+    query = update.callback_query
+    creds = await load_creds(context, update.effective_user.id)
+    if not creds:
+        await safe_edit_or_send(query, MSG_NEED_CONNECT, reply_markup=main_kb(False))
         return ConversationHandler.END
 
+    await safe_edit_or_send(query, MSG_CHECKING)
+    # Проверка идёт секундами: не держим на ней обработку апдейтов, выполняем в фоне.
+    # Application.create_task хранит ссылку на задачу и отдаёт исключения в error handler.
+    context.application.create_task(_run_check(query, creds, force=force), update=update)
     return ConversationHandler.END
 
+async def _on_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _on_check(update, context, force=True)
+
+async def _on_unlink(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid = update.effective_user.id
+    creds = await load_creds(context, uid)
+    await delete_user(uid)
+    context.user_data.pop("creds", None)
+    if creds:
+        forget_status(creds.case_no, creds.password)
+    await safe_edit_or_send(query, MSG_UNLINKED, reply_markup=main_kb(False))
+    return ConversationHandler.END
+
+# callback_data -> обработчик кнопки
+_BUTTONS = {
+    "connect": _on_connect,
+    "check": _on_check,
+    "refresh": _on_refresh,
+    "unlink": _on_unlink,
+}
+
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    handler = _BUTTONS.get(query.data)
+    if handler is None:
+        return ConversationHandler.END
+    return await handler(update, context)
+
 async def ask_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
     case_no = update.message.text.strip()
     context.user_data["connect"]["case_no"] = case_no
-    await update.message.reply_text("Принято. Теперь отправь *пароль* (Hasło):", parse_mode="Markdown")
+    await update.message.reply_text(MSG_ASK_PASS, parse_mode="Markdown")
     return AWAIT_PASS
 
 async def save_creds(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -379,23 +895,38 @@ async def save_creds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pwd = update.message.text.strip()
     case_no = context.user_data.get("connect", {}).get("case_no")
     if not case_no:
-        await update.message.reply_text(
-            "Что-то пошло не так. Нажми «🔑 Подключить дело» и начни заново.",
-            reply_markup=main_kb(False),
-        )
+        await update.message.reply_text(MSG_RESTART, reply_markup=main_kb(False))
         return ConversationHandler.END
-    upsert_creds(uid, case_no, pwd)
-    await update.message.reply_text(
-        "Готово! Данные сохранены.\nТеперь просто жми «🔍 Проверить статус».",
-        reply_markup=main_kb(True),
-    )
+    old = await get_creds(uid)
+    await upsert_creds(uid, case_no, pwd)
+    if old is not None:
+        forget_status(old.case_no, old.password)  # кэш и сессия старых данных больше не нужны
+    context.user_data.pop("creds", None)
+    await update.message.reply_text(MSG_SAVED, reply_markup=main_kb(True))
     return ConversationHandler.END
 
 async def cancel_conv(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Окей, отменил.", reply_markup=main_kb(False))
+    await update.message.reply_text(MSG_CANCELLED, reply_markup=main_kb(False))
     return ConversationHandler.END
 
 # ---------- main ----------
+async def _warm_browser():
+    # не критично для старта: если Browserless недоступен, подключимся при первой проверке
+    try:
+        await get_browser()
+    except Exception as e:
+        log.warning("Не удалось заранее подключиться к удалённому браузеру: %s", e)
+
+async def on_startup(app: Application):
+    start_scrape_workers()
+    # миграция БД и подключение к Browserless независимы — идут параллельно
+    await asyncio.gather(init_db(), _warm_browser())
+
+async def on_shutdown(app: Application):
+    await stop_scrape_workers()
+    await close_browser()
+    await close_db()
+
 def main():
     if not TELEGRAM_TOKEN:
         raise SystemExit("TELEGRAM_TOKEN не задан.")
@@ -403,8 +934,21 @@ def main():
         raise SystemExit("PUBLIC_URL должен начинаться с https://")
     if not WEBHOOK_SECRET_TOKEN:
         raise SystemExit("WEBHOOK_SECRET_TOKEN не задан.")
-    ensure_schema()
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    if not SECRET_KEY:
+        raise SystemExit("SECRET_KEY не задан.")
+    try:
+        get_aead()
+    except ValueError:
+        raise SystemExit("SECRET_KEY некорректен: нужен ключ Fernet (32 байта в urlsafe base64).")
+    app = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Telegram пускает ~30 сообщений/сек на бота: лимитер встаёт в очередь и соблюдает retry_after при 429
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=3))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", greet))
     conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(on_button)],